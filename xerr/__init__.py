@@ -40,6 +40,7 @@ This package is modelled after equally-named Go package.
 """
 
 import traceback
+import weakref
 
 # Error is exception that represents an error.
 #
@@ -47,73 +48,125 @@ import traceback
 # caused this error.
 #
 # It is similar to `raise ... from ...` in python3.
+#
+# (err, cause_exc, cause_tb) are kept in .args, which BaseException stores as
+# a tuple, so that walking error chain needs only one tuple unpack per link.
 class Error(Exception):
+    __slots__ = ('_str',)   # memoized __str__ result | None
+
     def __init__(self, err, cause_exc=None, cause_tb=None):
-        self.err, self.cause_exc, self.cause_tb = err, cause_exc, cause_tb
+        Exception.__init__(self, err, cause_exc, cause_tb)
+        self._str = None
+
+    err         = property(lambda self: self.args[0])
+    cause_exc   = property(lambda self: self.args[1])
+    cause_tb    = property(lambda self: self.args[2])
 
     # __str__ returns string representation of the error.
     #
     # besides main error line, it also includes cause traceback, if cause is
     # not "well-defined-error".
+    #
+    # the result is computed once and memoized, as the same error is often
+    # stringified several times, e.g. by several logging handlers.
     def __str__(self):
+        s = self._str
+        if s is None:
+            s = self._str = self._format()
+        return s
+
+    def _format(self):
+        # fast path for leaf error
+        err, cause_exc, cause_tb = self.args
+        if cause_exc is None and cause_tb is None:
+            return str(err)
+
         errv = []   # of .err + .cause_exc in the end
+        append = errv.append
+        _Error = Error
         e = self
-        while isinstance(e, Error):
-            errv.append(e.err)
-            tb = e.cause_tb
-            e  = e.cause_exc
+        while type(e) is _Error or isinstance(e, _Error):
+            last = e
+            args = e.args
+            append(args[0])
+            e = args[1]
+
+        # only traceback of the deepest cause is shown
+        tb = last.args[2]
 
         # !Error cause
         if e is not None:
             errv.append(e)
 
-        s = ": ".join(["%s" % _ for _ in errv])
+        s = ": ".join(map(str, errv))
 
         # cause traceback
+        # (well_defined(e) inlined)
         if tb is not None:
-            if not well_defined(e):
-                s += "\n\ncause traceback:\n%s" % ('\n'.join(traceback.format_tb(tb)),)
+            if not (type(e) in _wde_classset or isinstance(e, _wde_classv) or
+                    id(e) in _wde_objectd):
+                s += "\n\ncause traceback:\n" + "\n".join(traceback.format_tb(tb))
 
         return s
 
     def __repr__(self):
-        return "Error(%r, %r, %r)" % (self.err, self.cause_exc, self.cause_tb)
+        err, cause_exc, cause_tb = self.args
+        return "Error(" + repr(err) + ", " + repr(cause_exc) + ", " + repr(cause_tb) + ")"
 
 
 # well_defined returns whether err is well-defined error or not.
 #
 # well-defined-errors are those that carry on all information and do not need
 # traceback to interpret them if they are wrapped with another Error properly.
+#
+# classes are accumulated in _wde_classl; _wde_classv is its tuple form
+# rebuilt on registration, since isinstance accepts only tuples. _wde_classset
+# is the same set of classes used to answer the common exact-type case with
+# one hash lookup; isinstance is consulted only for subclasses.
+#
+# objects are registered by identity: _wde_objectd maps id() of registered
+# object to weak reference to it. The entry is removed when the object goes
+# away, so that registry does not pin objects and its id cannot be matched by
+# another object. Objects that do not support weak references (e.g. instances
+# of builtin exceptions) are kept in _wde_objectd directly.
+_wde_classl  = []
 _wde_classv  = ()
-_wde_objectv = ()
+_wde_classset= frozenset()
+_wde_objectd = {}     # id(obj) -> weakref(obj) | obj
 def well_defined(err):
-    if isinstance(err, _wde_classv):
-        return True
-
-    for e in _wde_objectv:
-        if e is err:
-            return True
-
-    return False
+    return type(err) in _wde_classset or isinstance(err, _wde_classv) or \
+           id(err) in _wde_objectd
 
 # register_wde_* let Error know that an error type or object is well-defined.
 def register_wde_class(exc_class):
-    global _wde_classv
-    _wde_classv += (exc_class,)
+    global _wde_classv, _wde_classset
+    _wde_classl.append(exc_class)
+    _wde_classv   = tuple(_wde_classl)
+    _wde_classset = frozenset(_wde_classl)
 
 def register_wde_object(exc_object):
-    global _wde_objectv
-    _wde_objectv += (exc_object,)
+    i = id(exc_object)
+    def _(ref):
+        if _wde_objectd.get(i) is ref:
+            del _wde_objectd[i]
+    try:
+        _wde_objectd[i] = weakref.ref(exc_object, _)
+    except TypeError:
+        _wde_objectd[i] = exc_object
 
 register_wde_class(Error)
 
 
 # cause returns deepest !None cause of an error.
-def cause(err):
-    while isinstance(err, Error):
-        if err.cause_exc is None:
+#
+# (Error is bound to local _Error, and exact type is checked first, as this
+#  is the common case and is cheaper than isinstance)
+def cause(err, _Error=Error):
+    while type(err) is _Error or isinstance(err, _Error):
+        c = err.args[1]
+        if c is None:
             return err
-        err = err.cause_exc
+        err = c
 
     return err
 
@@ -138,3 +191,29 @@ class context(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_val is not None:
             raise Error(self.errprefix, exc_val, exc_tb)
+
+    # specialize returns context manager class with errprefix fixed.
+    #
+    # it is handy for hot code with constant error prefix:
+    #
+    #   _ctxX = xerr.context.specialize("doing X")
+    #
+    #   def doX():
+    #       with _ctxX():
+    #           ...
+    #
+    # with errprefix bound in closure there is no per-instance state to set
+    # up on enter and to load back on exit.
+    @staticmethod
+    def specialize(errprefix):
+        class _context(object):
+            __slots__ = ()
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                if exc_val is not None:
+                    raise Error(errprefix, exc_val, exc_tb)
+
+        return _context
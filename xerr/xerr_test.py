@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018  Nexedi SA and Contributors.
+#                     Kirill Smelkov <kirr@nexedi.com>
+#
+# This program is free software: you can Use, Study, Modify and Redistribute
+# it under the terms of the GNU General Public License version 3, or (at your
+# option) any later version, as published by the Free Software Foundation.
+#
+# You can also Link and Combine this program with other software covered by
+# the terms of any of the Free Software licenses or any of the Open Source
+# Initiative approved licenses and Convey the resulting work. Corresponding
+# source of such a combination shall include the source code for all other
+# software used.
+#
+# This program is distributed WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See COPYING file for full licensing terms.
+# See https://www.nexedi.com/licensing for rationale and options.
+
+from golang import gimport
+xerr = gimport('lab.nexedi.com/kirr/go123/xerr')
+Error = xerr.Error
+
+
+def test_error():
+    cause = Error("zzz")
+    e = Error("aaa", cause, None)
+    assert e.err       == "aaa"
+    assert e.cause_exc is cause
+    assert e.cause_tb  is None
+    assert e.args      == ("aaa", cause, None)
+
+    # .err, .cause_exc and .cause_tb are read-only
+    for attr in ('err', 'cause_exc', 'cause_tb'):
+        try:
+            setattr(e, attr, "bbb")
+        except AttributeError:
+            pass
+        else:
+            assert 0, "Error.%s is writable" % attr
+
+    # str is computed once and memoized
+    s = str(e)
+    assert s == "aaa: zzz"
+    assert str(e) is s
+
+
+def test_context_specialize():
+    ctx = xerr.context.specialize("doing X")
+
+    # no exception - nothing is wrapped
+    with ctx():
+        pass
+
+    # well-defined cause - no traceback in str
+    cause = Error("zzz")
+    try:
+        with ctx():
+            raise cause
+    except Error as e:
+        assert str(e) == "doing X: zzz"
+        assert xerr.cause(e) is cause
+        assert e.args[:2] == ("doing X", cause)
+        assert e.args[2] is not None
+    else:
+        assert 0, "exception not raised"
+
+    # not well-defined cause - str includes cause traceback
+    cause = RuntimeError("qqq")
+    try:
+        with ctx():
+            raise cause
+    except Error as e:
+        assert str(e).startswith("doing X: qqq\n\ncause traceback:\n")
+        assert xerr.cause(e) is cause
+        assert e.args[:2] == ("doing X", cause)
+        assert e.args[2] is not None
+    else:
+        assert 0, "exception not raised"
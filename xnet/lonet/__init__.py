@@ -27,13 +27,16 @@ See lonet.go for lonet description, organization and protocol.
 
 import sys, os, stat, errno, tempfile, re
 import socket as net
+import select as oselect
 
 import sqlite3
 import functools
+import heapq
+import collections
 import threading
 import logging as log
 
-from golang import func, defer, go, chan, select, default, panic, gimport
+from golang import func, go, chan, select, default, panic, gimport
 from golang import sync
 from golang.gcompat import qq
 
@@ -43,30 +46,6 @@ errctx  = xerr.context
 errcause= xerr.cause
 
 
-# set_once sets threading.Event, but only once.
-#
-# it returns whether event was set.
-#
-#   if set_once(down_once):
-#     ...
-#
-# is analog of
-#
-#   downOnce.Do(...)
-#
-# in Go.
-#
-# TODO just use sync.Once from pygolang.
-_oncemu = threading.Lock()
-def set_once(event):
-    with _oncemu:
-        if event.is_set():
-            return False
-        event.set()
-        return True
-
-
-
 # -------- virtnet --------
 #
 # See ../virtnet/virtnet.go for details.
@@ -97,6 +76,7 @@ class Addr(object):
     # .net  str
     # .host str
     # .port int
+    __slots__ = ('net', 'host', 'port')
 
     def __init__(self, net, host, port):
         self.net, self.host, self.port = net, host, port
@@ -115,23 +95,25 @@ class Addr(object):
 # VirtSubNetwork represents one subnetwork of a virtnet network.
 class VirtSubNetwork(object):
     # ._network     str
+    # ._qnetwork    str ; qq(._network), precomputed for error contexts and handshake
     # ._registry    Registry
     # ._hostmu      μ
     # ._hostmap     {} hostname -> Host
     # ._nopenhosts  int
     # ._autoclose   bool
     # ._down        chan ø
-    # ._down_once   threading.Event
+    # ._down_once   sync.Once
 
     def __init__(self, network, registry):
         self._network    = network
+        self._qnetwork   = qq(network)
         self._registry   = registry
         self._hostmu     = threading.Lock()
         self._hostmap    = {}
         self._nopenhosts = 0
         self._autoclose  = False
         self._down       = chan()
-        self._down_once  = threading.Event()
+        self._down_once  = sync.Once()
 
     # must be implemented in particular virtnet implementation
     def _vnet_newhost(self, hostname, registry):    raise NotImplementedError()
@@ -145,8 +127,10 @@ class Host(object):
     # ._name        str
     # ._sockmu      μ
     # ._socketv     []socket ; port -> listener | conn ; [0] is always None
+    # ._freeports   []port   ; min-heap of free ports in ._socketv (might have stale entries)
+    # ._freeportset {port}   ; ports that are in ._freeports
     # ._down        chan ø
-    # ._down_once   threading.Event
+    # ._down_once   sync.Once
     # ._close_once  sync.Once
 
     def __init__(self, subnet, name):
@@ -154,8 +138,10 @@ class Host(object):
         self._name       = name
         self._sockmu     = threading.Lock()
         self._socketv    = []
+        self._freeports  = []
+        self._freeportset= set()
         self._down       = chan()
-        self._down_once  = threading.Event()
+        self._down_once  = sync.Once()
         self._close_once = sync.Once()
 
 
@@ -166,6 +152,7 @@ class socket(object):
 
     # ._conn      conn | None
     # ._listener  listener | None
+    __slots__ = ('_host', '_port', '_conn', '_listener')
 
     def __init__(self, host, port):
         self._host, self._port = host, port
@@ -178,14 +165,15 @@ class conn(object):
     # ._peerAddr    Addr
     # ._netsk       net.socket (embedded)
     # ._down        chan()
-    # ._down_once   threading.Event
-    # ._close_once  threading.Event
+    # ._down_once   sync.Once
+    # ._close_once  sync.Once
+    __slots__ = ('_socket', '_peerAddr', '_netsk', '_down', '_down_once', '_close_once')
 
     def __init__(self, sk, peerAddr, netsk):
         self._socket, self._peerAddr, self._netsk = sk, peerAddr, netsk
         self._down       = chan()
-        self._down_once  = threading.Event()
-        self._close_once = threading.Event()
+        self._down_once  = sync.Once()
+        self._close_once = sync.Once()
 
     # ._netsk embedded:
     def __getattr__(self, name):
@@ -197,15 +185,16 @@ class listener(object):
     # ._socket      socket
     # ._dialq       chan dialReq
     # ._down        chan ø
-    # ._down_once   threading.Event
-    # ._close_once  threading.Event
+    # ._down_once   sync.Once
+    # ._close_once  sync.Once
+    __slots__ = ('_socket', '_dialq', '_down', '_down_once', '_close_once')
 
     def __init__(self, sk):
         self._socket     = sk
         self._dialq      = chan()
         self._down       = chan()
-        self._down_once  = threading.Event()
-        self._close_once = threading.Event()
+        self._down_once  = sync.Once()
+        self._close_once = sync.Once()
 
 
 # dialReq represents one dial request to listener from acceptor.
@@ -234,7 +223,12 @@ def _shutdown(n, exc):
     n.__shutdown(exc, True)
 @func(VirtSubNetwork)
 def __shutdown(n, exc, withHosts):
-    if not set_once(n._down_once):
+    # only mark shutdown under ._down_once, and do the work outside of it:
+    # sync.Once holds its lock while running the function, and _vnet_close
+    # waits for serve thread, which itself might be calling _vnet_down.
+    first = []
+    n._down_once.do(lambda: first.append(True))
+    if not first:
         return
 
     n._down.close()
@@ -260,27 +254,27 @@ def _closeWithoutHosts(n):
     n.__close(False)
 @func(VirtSubNetwork)
 def __close(n, withHosts):
-    with errctx("virtnet %s: close" % qq(n._network)):
+    with errctx("virtnet %s: close" % n._qnetwork):
         n.__shutdown(None, withHosts)
 
 # _vnet_down shutdowns subnetwork upon engine error.
 @func(VirtSubNetwork)
 def _vnet_down(n, exc):
     # XXX py: errctx here (go does not have) because we do not reraise .downErr in close
-    with errctx("virtnet %s: shutdown" % qq(n._network)):
+    with errctx("virtnet %s: shutdown" % n._qnetwork):
         n._shutdown(exc)
 
 
 # new_host creates new Host with given name.
 @func(VirtSubNetwork)
 def new_host(n, name):
-    with errctx("virtnet %s: new host %s" % (qq(n._network), qq(name))):
+    with errctx("virtnet %s: new host %s" % (n._qnetwork, qq(name))):
         n._vnet_newhost(name, n._registry)
         # XXX check err due to subnet down
 
         with n._hostmu:
             if name in n._hostmap:
-                panic("announced ok but .hostMap already !empty" % (qq(n._network), qq(name)))
+                panic("announced ok but .hostMap already !empty")
 
             host = Host(n, name)
             n._hostmap[name] = host
@@ -298,43 +292,45 @@ def host(n, name):
 # _shutdown is underlying worker for close.
 @func(Host)
 def _shutdown(h):
-    if not set_once(h._down_once):
-        return
-
-    h._down.close()
+    def _():
+        h._down.close()
 
-    with h._sockmu:
-        for sk in h._socketv:
-            if sk is None:
-                continue
-            if sk._conn is not None:
-                sk._conn._shutdown()
-            if sk._listener is not None:
-                sk._listener._shutdown()
+        with h._sockmu:
+            for sk in h._socketv:
+                if sk is None:
+                    continue
+                if sk._conn is not None:
+                    sk._conn._shutdown()
+                if sk._listener is not None:
+                    sk._listener._shutdown()
+    h._down_once.do(_)
 
 # close shutdowns host.
 @func(Host)
 def close(h):
-    def autoclose():
-        def _():
-            n = h._subnet
-            with n._hostmu:
-                n._nopenHosts -= 1
-                if n._nopenHosts < 0:
-                    panic("SubNetwork._nopenHosts < 0")
-                if n._autoclose and n._nopenHosts == 0:
-                    n._closeWithoutHosts()
-        h._close_once.do(_)
-    defer(autoclose)
-
-    with errctx("virtnet %s: host %s: close" % (qq(h._subnet._network), qq(h._name))):
-        h._shutdown()
+    try:
+        with errctx("virtnet %s: host %s: close" % (h._subnet._qnetwork, qq(h._name))):
+            h._shutdown()
+    finally:
+        h._close_once.do(h._closeAccount)
+
+# _closeAccount accounts closed host in its subnetwork and closes the subnetwork
+# if it is in autoclose mode and this was its last open host.
+@func(Host)
+def _closeAccount(h):
+    n = h._subnet
+    with n._hostmu:
+        n._nopenhosts -= 1
+        if n._nopenhosts < 0:
+            panic("SubNetwork._nopenhosts < 0")
+        if n._autoclose and n._nopenhosts == 0:
+            n._closeWithoutHosts()
 
 # autoclose schedules close to be called after last host on this subnetwork is closed.
 @func(VirtSubNetwork)
 def autoclose(n):
     with n._hostmu:
-        if n._nopenHosts == 0:
+        if n._nopenhosts == 0:
             panic("BUG: no opened hosts")
         n._autoclose = True
 
@@ -359,8 +355,14 @@ def listen(h, laddr):
                 sk = h._allocFreeSocket()
 
             else:
-                while a.port >= len(h._socketv):
-                    h._socketv.append(None)
+                nport = len(h._socketv)
+                if a.port >= nport:
+                    h._socketv.extend([None] * (a.port + 1 - nport))
+                    # new ports are all > ports already in the heap, so
+                    # appending them in increasing order keeps heap invariant.
+                    newfree = range(max(nport, 1), a.port)
+                    h._freeports.extend(newfree)
+                    h._freeportset.update(newfree)
 
                 if h._socketv[a.port] is not None:
                     raise ErrAddrAlreadyUsed
@@ -377,23 +379,21 @@ def listen(h, laddr):
 # _shutdown shutdowns the listener.
 @func(listener)
 def _shutdown(l):
-    if set_once(l._down_once):
-        l._down.close()
+    l._down_once.do(l._down.close)
 
 # close closes the listener.
 @func(listener)
 def close(l):
     l._shutdown()
-    if not set_once(l._close_once):
-        return
-
-    sk = l._socket
-    h  = sk._host
+    def _():
+        sk = l._socket
+        h  = sk._host
 
-    with h._sockmu:
-        sk._listener = None
-        if sk._empty():
-            h._socketv[sk.port] = None
+        with h._sockmu:
+            sk._listener = None
+            if sk._empty():
+                h._freeSocket(sk)
+    l._close_once.do(_)
 
 
 # accept tries to connect to dial called with addr corresponding to our listener.
@@ -415,7 +415,9 @@ def accept(l):
             with h._sockmu:
                 sk = h._allocFreeSocket()
 
-            ack = chan()
+            # ack is single-shot: buffer it so that acceptor does not block
+            # on sending it, even if we already went away due to l.down .
+            ack = chan(1)
             req._resp.send(Accept(sk.addr(), ack))
 
             _, _rx = select(
@@ -423,17 +425,25 @@ def accept(l):
                 ack.recv,       # 1
             )
             if _ == 0:
-                def purgesk():
-                    err = ack.recv()
+                def purgesk(err):
                     if err is None:
                         try:
                             req._netsk.close()
                         except:
                             pass
                     with h._sockmu:
-                        h._socketv[sk._port] = None
-
-                go(purgesk)
+                        h._freeSocket(sk)
+
+                # purge right away if acceptor already replied; spawn
+                # goroutine to wait for its reply only if not.
+                _, _rx = select(
+                    ack.recv,   # 0
+                    default,    # 1
+                )
+                if _ == 0:
+                    purgesk(_rx)
+                if _ == 1:
+                    go(lambda: purgesk(ack.recv()))
                 l._excDown()
 
             if _ == 1:
@@ -441,12 +451,12 @@ def accept(l):
 
             if err is not None:
                 with h._sockmu:
-                    h._socketv[sk._port] = None
+                    h._freeSocket(sk)
                 continue
 
             c = conn(sk, req._from, req._netsk)
             with h._sockmu:
-                sk.conn = c
+                sk._conn = c
 
             return c
 
@@ -473,7 +483,10 @@ def _vnet_accept(n, src, dst, netconn):
     l = sk._listener
     host._sockmu.release()
 
-    resp = chan()
+    # resp is single-shot: buffer it so that accept does not wait for us to
+    # rendezvous. ._dialq is kept unbuffered, so that dial request is never
+    # left queued on a listener that goes down before accepting it.
+    resp = chan(1)
     req  = dialReq(src, netconn, resp)
 
     _, _rx = select(
@@ -514,7 +527,7 @@ def dial(h, addr):
 
     except Exception as err:
         with h._sockmu:
-            h._socketv[sk._port] = None
+            h._freeSocket(sk)
 
         _, _, tb = sys.exc_info()
         raise Error("dial %s %s->%s" % (h.network(), sk.addr(), dst), err, tb)
@@ -525,32 +538,54 @@ def dial(h, addr):
 # _shutdown closes underlying network connection.
 @func(conn)
 def _shutdown(c):
-    if not set_once(c._down_once):
-        return
-
-    c._down.close()
-    # XXX py: we don't remember .errClose
-    c._netsk.close()
+    def _():
+        c._down.close()
+        # XXX py: we don't remember .errClose
+        c._netsk.close()
+    c._down_once.do(_)
 
 
 # close closes network endpoint and unregisters conn from Host.
 @func(conn)
 def close(c):
     c._shutdown()
-    if set_once(c._close_once):
+    def _():
         sk = c._socket
         h  = sk._host
 
         with h._sockmu:
             sk._conn = None
             if sk._empty():
-                h._socketv[sk._port] = None
+                h._freeSocket(sk)
+    c._close_once.do(_)
 
     # XXX py: we don't reraise c.errClose
 
 # XXX py: don't bother to override recv (Read)
 # XXX py: don't bother to override send (Write)
 
+# I/O methods are forwarded to ._netsk explicitly, so that hot path does not go
+# through __getattr__ on every call.
+@func(conn)
+def recv(c, *argv, **kw):
+    return c._netsk.recv(*argv, **kw)
+
+@func(conn)
+def recv_into(c, *argv, **kw):
+    return c._netsk.recv_into(*argv, **kw)
+
+@func(conn)
+def send(c, *argv, **kw):
+    return c._netsk.send(*argv, **kw)
+
+@func(conn)
+def sendall(c, *argv, **kw):
+    return c._netsk.sendall(*argv, **kw)
+
+@func(conn)
+def fileno(c):
+    return c._netsk.fileno()
+
 # local_addr returns virtnet address of local end of connection.
 @func(conn)
 def local_addr(c):
@@ -574,21 +609,40 @@ def getpeername(c):
 # ----------------------------------------
 
 # _allocFreeSocket finds first free port and allocates socket entry for it.
+#
+# must be called under h._sockmu.
 @func(Host)
 def _allocFreeSocket(h):
-    port = 1
-    while port < len(h._socketv):
-        if h._socketv[port] is None:
+    # free ports are taken from h._freeports. Entries for ports that were
+    # since occupied by listen with explicit port are stale and are skipped.
+    while 1:
+        if len(h._freeports) == 0:
+            port = max(len(h._socketv), 1)
+            h._socketv.extend([None] * (port + 1 - len(h._socketv)))
             break
-        port += 1
 
-    while port >= len(h._socketv):
-        h._socketv.append(None)
+        port = heapq.heappop(h._freeports)
+        h._freeportset.remove(port)
+        if h._socketv[port] is None:
+            break
 
     sk = socket(h, port)
     h._socketv[port] = sk
     return sk
 
+# _freeSocket releases port of socket entry sk for reuse.
+#
+# must be called under h._sockmu.
+@func(Host)
+def _freeSocket(h, sk):
+    port = sk._port
+    h._socketv[port] = None
+    # a port can be still in the heap as stale entry - don't push it twice,
+    # or else repeated listen/close on explicit port would grow the heap forever.
+    if port not in h._freeportset:
+        heapq.heappush(h._freeports, port)
+        h._freeportset.add(port)
+
 
 # empty checks whether socket's both conn and listener are all nil.
 @func(socket)
@@ -605,13 +659,13 @@ def addr(sk):
 @func(Addr)
 @staticmethod
 def parse(net, addr):
-    try:
-        addrv = addr.split(':')
-        if len(addrv) != 2:
-            raise ValueError()
-        return Addr(net, addrv[0], int(addrv[1]))
-    except:
-        raise ValueError('%s is not valid virtnet address' % addr)
+    host, colon, port = addr.rpartition(':')
+    if colon and ':' not in host:
+        try:
+            return Addr(net, host, int(port))
+        except ValueError:
+            pass
+    raise ValueError('%s is not valid virtnet address' % addr)
 
 # _parseAddr parses addr into virtnet address from host point of view.
 @func(Host)
@@ -718,12 +772,21 @@ def join(network):
 # lonet handshake:
 # scanf("> lonet %q dial %q %q\n", network, src, dst)
 # scanf("< lonet %q %s %q\n", network, reply, arg)
-_lodial_re  = re.compile(r'> lonet "(?P<network>.*?[^\\])" dial "(?P<src>.*?[^\\])" "(?P<dst>.*?[^\\])"\n')
-_loreply_re = re.compile(r'< lonet "(?P<network>.*?[^\\])" (?P<reply>[^\s]+) "(?P<arg>.*?[^\\])"\n')
+_lodial_re  = re.compile(br'> lonet "(?P<network>.*?[^\\])" dial "(?P<src>.*?[^\\])" "(?P<dst>.*?[^\\])"\n')
+_loreply_re = re.compile(br'< lonet "(?P<network>.*?[^\\])" (?P<reply>[^\s]+) "(?P<arg>.*?[^\\])"\n')
+
+# _unquote unescapes %q-quoted string matched by _lodial_re / _loreply_re.
+def _unquote(s):
+    # fast path: most strings have nothing escaped
+    if "\\" not in s:
+        return s
+    return s.decode('string_escape')
 
 # _SubNetwork represents one subnetwork of a lonet network.
 class _SubNetwork(VirtSubNetwork):
     # ._oslistener  net.socket
+    # ._wakeup_r    fd  ; pipe to wake up ._serve on close
+    # ._wakeup_w    fd
     # ._tserve      Thread(._serve)
 
     def __init__(n, network, registry):
@@ -735,11 +798,14 @@ class _SubNetwork(VirtSubNetwork):
             oslistener.bind(("127.0.0.1", 0))
             oslistener.listen(1024)
 
+            wakeup_r, wakeup_w = os.pipe()
+
         except:
             registry.close()
             raise
 
         n._oslistener = oslistener
+        n._wakeup_r, n._wakeup_w = wakeup_r, wakeup_w
 
         # XXX -> go(n._serve, serveCtx) + cancel serveCtx in close
         n._tserve = threading.Thread(target=n._serve, name="%s/serve" % n._network)
@@ -749,42 +815,81 @@ class _SubNetwork(VirtSubNetwork):
     def _vnet_close(n):
         # XXX py: no errctx here - it is in _vnet_down
         # XXX cancel + join tloaccept*
+        os.write(n._wakeup_w, "x")
+        if threading.current_thread() is not n._tserve: # _vnet_down from _serve
+            n._tserve.join()
         n._oslistener.close()
-        n._tserve.join()
+        os.close(n._wakeup_r)
+        os.close(n._wakeup_w)
 
 
     # _serve serves incoming OS-level connections to this subnetwork.
     def _serve(n):
-        # XXX net.socket.close does not interrupt sk.accept
-        # XXX we workaround it with accept timeout and polling for ._down
-        n._oslistener.settimeout(1E-3)   # 1ms
-        while 1:
-            if ready(n._down):
-                break
+        try:
+            n.__serve()
+        except Exception as e:
+            n._vnet_down(e)
 
+    def __serve(n):
+        # net.socket.close does not interrupt sk.accept
+        # -> wait for either incoming connection or wakeup from _vnet_close.
+        #
+        # ( poll, not select, because select cannot handle fd >= FD_SETSIZE )
+        n._oslistener.setblocking(False)
+        myaddr = addrstr4(*n._oslistener.getsockname())
+        poller = oselect.poll()
+        poller.register(n._oslistener, oselect.POLLIN)
+        poller.register(n._wakeup_r,   oselect.POLLIN)
+        while 1:
+            # wakeup is signalled only by _vnet_close, which runs after
+            # n._down is closed - no need to separately poll n._down .
             try:
-                osconn, _ = n._oslistener.accept()
-            except net.timeout:
-                continue
+                eventv = poller.poll()
+            except oselect.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
 
-            except Exception as e:
-                n._vnet_down(e)
-                return
+            for fd, _ in eventv:
+                if fd == n._wakeup_r:
+                    return
 
-            # XXX wg.Add(1)
-            def _(osconn):
-                # XXX defer wg.Done()
+            # accept all pending connections per wakeup, not only one
+            while 1:
+                try:
+                    osconn, peer = n._oslistener.accept()
+                except net.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
 
-                myaddr   = addrstr4(*n._oslistener.getsockname())
-                peeraddr = addrstr4(*osconn.getpeername())
+                osconn.setblocking(True)    # might inherit O_NONBLOCK from oslistener
 
-                try:
-                    n._loaccept(osconn)
-                except Exception as e:
-                    if errcause(e) is not ErrConnRefused:
-                        log.error("lonet %s: serve %s <- %s : %s" % (qq(n._network), myaddr, peeraddr, e))
+                # XXX wg.Add(1)
+                go(n._serveconn, osconn, myaddr, peer)
+
+    # _serveconn handles one OS-level connection accepted by _serve.
+    #
+    # a goroutine is used per connection, not a fixed pool of workers, because
+    # _loaccept blocks until lonet-level accept is called on a listener.
+    def _serveconn(n, osconn, myaddr, peer):
+        # XXX defer wg.Done()
+
+        # TCP_NODELAY is only an optimization - ignore error setting it, as Go
+        # does, e.g. if peer has already reset the connection.
+        try:
+            _nodelay(osconn)
+        except net.error:
+            pass
 
-            go(_, osconn)
+        try:
+            n._loaccept(osconn)
+        except Exception as e:
+            if errcause(e) is not ErrConnRefused:
+                peeraddr = addrstr4(*peer)
+                log.error("lonet %s: serve %s <- %s : %s" % (n._qnetwork, myaddr, peeraddr, e))
 
 
     # --- acceptor vs dialer ---
@@ -804,7 +909,7 @@ class _SubNetwork(VirtSubNetwork):
         line = skreadline(osconn, 1024)
 
         def reply(reply):
-            line = "< lonet %s %s\n" % (qq(n._network), reply)
+            line = "< lonet %s %s\n" % (n._qnetwork, reply)
             osconn.sendall(line)
 
         def ereply(err, tb):
@@ -825,9 +930,9 @@ class _SubNetwork(VirtSubNetwork):
         if m is None:
             eproto("invalid dial request", "%s" % qq(line))
 
-        network = m.group('network').decode('string_escape')
-        src     = m.group('src').decode('string_escape')
-        dst     = m.group('dst').decode('string_escape')
+        network = _unquote(m.group('network'))
+        src     = _unquote(m.group('src'))
+        dst     = _unquote(m.group('dst'))
 
         if network != n._network:
             eproto("network mismatch", "%s" % qq(network))
@@ -864,27 +969,31 @@ class _SubNetwork(VirtSubNetwork):
         try:
             return n.__loconnect(osconn, src, dst)
         except Exception as err:
+            # ErrConnRefused remains unwrapped - reraise it as is without
+            # querying peer address and traceback that are used only for wrapping.
+            if err is ErrConnRefused:
+                osconn.close()
+                raise
+
             peeraddr = addrstr4(*osconn.getpeername())
 
             # close osconn on error
             osconn.close()
 
             _, _, tb = sys.exc_info()
-            if err is not ErrConnRefused:
-                err = Error("loconnect %s" % peeraddr, err, tb)
-            raise err
+            raise Error("loconnect %s" % peeraddr, err, tb)
 
 
     def __loconnect(n, osconn, src, dst):
-        osconn.sendall("> lonet %s dial %s %s\n" % (qq(n._network), qq(src), qq(dst)))
+        osconn.sendall("> lonet %s dial %s %s\n" % (n._qnetwork, qq(src), qq(dst)))
         line = skreadline(osconn, 1024)
         m = _loreply_re.match(line)
         if m is None:
             raise protocolError("invalid dial reply: %s" % qq(line))
 
-        network = m.group('network').decode('string_escape')
+        network = _unquote(m.group('network'))
         reply   = m.group('reply') # no unescape
-        arg     = m.group('arg').decode('string_escape')
+        arg     = _unquote(m.group('arg'))
 
         if reply == "E":
             if arg == "connection refused":
@@ -920,6 +1029,7 @@ class _SubNetwork(VirtSubNetwork):
             raise ValueError('%s is not valid TCP address' % dstosladdr)
 
         osconn = net.socket(net.AF_INET, net.SOCK_STREAM)
+        _nodelay(osconn)
         osconn.connect((a.host, a.port))
         addrAccept = n._loconnect(osconn, src, dst)
         return osconn, addrAccept
@@ -933,19 +1043,39 @@ def __str__(e):
     return "protocol error: %s" % e.args
 
 
+# _nodelay disables Nagle's algorithm on OS-level TCP socket.
+#
+# handshake and following small lonet-level writes should go out immediately,
+# not wait for ACK of previous segment. This also matches Go, where TCP
+# connections have TCP_NODELAY set by default.
+def _nodelay(sk):
+    sk.setsockopt(net.IPPROTO_TCP, net.TCP_NODELAY, 1)
+
+
 # skreadline reads 1 line from sk up to maxlen bytes.
+#
+# data past the line belongs to lonet connection payload and must not be
+# consumed. Instead of reading byte-by-byte, available data is first peeked,
+# and then only bytes up to and including "\n" are actually received.
 def skreadline(sk, maxlen):
-    line = ""
-    while len(line) < maxlen:
-        b = sk.recv(1)
+    linev = []  # of received chunks
+    l = 0       # = len(line)
+    while l < maxlen:
+        b = sk.recv(maxlen - l, net.MSG_PEEK)
         if len(b) == 0: # EOF
             raise Error('unexpected EOF')
-        assert len(b) == 1
-        line += b
-        if b == "\n":
+        eol = b.find("\n")
+        if eol != -1:
+            b = b[:eol+1]
+        n = len(b)
+        b = sk.recv(n)
+        assert len(b) == n  # peeked data is already in socket buffer
+        linev.append(b)
+        l += n
+        if eol != -1:
             break
 
-    return line
+    return "".join(linev)
 
 
 
@@ -985,10 +1115,24 @@ class DBPool(object):
         #
         # ( !check_same_thread because it is safe from long ago to pass SQLite
         #   connections in between threads, and with using pool it can happen. )
+        #
+        # ( connections are reused in LIFO order, so the most recently used
+        #   one, with warm statement cache, is handed out first; the cache is
+        #   made larger than default 100 to hold all registry statements with
+        #   room to spare. )
         def factory():
-            conn = sqlite3.connect(dburi, check_same_thread=False)
+            conn = sqlite3.connect(dburi, check_same_thread=False,
+                                   cached_statements=256)
             conn.text_factory    = str  # always return bytestrings - we keep text in UTF-8
             conn.isolation_level = None # autocommit
+            # WAL lets readers proceed concurrently with a writer, and with WAL
+            # synchronous=NORMAL is safe and does not fsync on every commit.
+            # This is done for every connection similarly to Go side, where
+            # crawshaw.io/sqlite opens connections in WAL mode by default.
+            # (in-memory databases do not support WAL)
+            if dburi != ":memory:":
+                conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
             return conn
 
         self._factory = factory             # None when pool closed
@@ -1052,13 +1196,23 @@ class _DBPoolContext(object):
 
 # SQLiteRegistry implements network registry as shared SQLite file.
 class SQLiteRegistry(object):
+    # .uri          str
+    # ._dbpool      DBPool
+    # ._hostcache   OrderedDict hostname -> osladdr ; LRU, oldest first
+    # ._hostcachemu threading.Lock
 
     schema_ver = "lonet.1"
+    hostcache_max = 128
 
     @_regerr
     def __init__(r, dburi, network):
         r.uri = dburi
         r._dbpool = DBPool(dburi)
+        # hosts are never removed from registry, so once host is found its
+        # entry stays valid and can be cached. Absent hosts are not cached -
+        # they could be announced by another process at any time.
+        r._hostcache   = collections.OrderedDict()
+        r._hostcachemu = threading.Lock()
         r._setup(network)
 
     def close(r):
@@ -1067,77 +1221,116 @@ class SQLiteRegistry(object):
     def _setup(r, network):
         with errctx('setup %s' % qq(network)):
             with r._dbpool.xget() as conn:
-                with conn:
-                    conn.execute("""
-                        CREATE TABLE IF NOT EXISTS hosts (
-                                hostname	TEXT NON NULL PRIMARY KEY,
-                                osladdr		TEXT NON NULL
-                        )
-                    """)
-
-                    conn.execute("""
-                    CREATE TABLE IF NOT EXISTS meta (
-                                name		TEXT NON NULL PRIMARY KEY,
-                                value		TEXT NON NULL
-                        )
-                    """)
-
-                    ver = r._config(conn, "schemaver")
-                    if ver == "":
-                        ver = r.schema_ver
-                        r._set_config(conn, "schemaver", ver)
-                    if ver != r.schema_ver:
-                        raise Error('schema version mismatch: want %s; have %s' % (qq(r._schema_ver), qq(ver)))
-
-                    dbnetwork = r._config(conn, "network")
-                    if dbnetwork == "":
-                        dbnetwork = network
-                        r._set_config(conn, "network", dbnetwork)
-                    if dbnetwork != network:
-                        raise Error('network name mismatch: want %s; have %s' % (qq(network), qq(dbnetwork)))
-
-
-    def _config(r, conn, name):
-        with errctx('config: get %s' % qq(name)):
-            rowv = query(conn, "SELECT value FROM meta WHERE name = ?", name)
-            if len(rowv) == 0:
-                return ""
-            if len(rowv) > 1:
-                raise Error("registry broken: duplicate config entries")
-            return rowv[0][0]
+                # do whole setup under one transaction, so that it is committed
+                # at once, and there is e.g. no race wrt another process
+                # setting config. IMMEDIATE takes write lock upfront, so that
+                # concurrent setups do not deadlock upgrading read locks.
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    r.__setup(conn, network)
+                except:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+
+    def __setup(r, conn, network):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS hosts (
+                    hostname	TEXT NON NULL PRIMARY KEY,
+                    osladdr		TEXT NON NULL
+            ) WITHOUT ROWID
+        """)
+
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+                    name		TEXT NON NULL PRIMARY KEY,
+                    value		TEXT NON NULL
+            )
+        """)
+
+        ver = r._config_init(conn, "schemaver", r.schema_ver)
+        if ver != r.schema_ver:
+            raise Error('schema version mismatch: want %s; have %s' % (qq(r.schema_ver), qq(ver)))
+
+        dbnetwork = r._config_init(conn, "network", network)
+        if dbnetwork != network:
+            raise Error('network name mismatch: want %s; have %s' % (qq(network), qq(dbnetwork)))
 
 
-    def _set_config(r, conn, name, value):
-        with errctx('config: set %s = %s' % (qq(name), qq(value))):
+    # _config_init gets registry configuration value by name.
+    #
+    # if there is no record corresponding to name - it is first initialized
+    # with default value.
+    def _config_init(r, conn, name, default):
+        with errctx('config: init %s = %s' % (qq(name), qq(default))):
             conn.execute(
-                    "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
-                    (name, value))
+                    "INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)",
+                    (name, default))
+            rowv = query(conn, "SELECT value FROM meta WHERE name = ?", name)
+            if len(rowv) != 1:
+                raise Error("registry broken: duplicate config entries")
+            return rowv[0][0]
 
 
     @_regerr
     def announce(r, hostname, osladdr):
         with r._dbpool.xget() as conn:
-            try:
-                conn.execute(
-                    "INSERT INTO hosts (hostname, osladdr) VALUES (?, ?)",
-                    (hostname, osladdr))
-            except sqlite3.IntegrityError as e:
-                if e.message.startswith('UNIQUE constraint failed'):
-                    raise ErrHostDup
-                raise
+            # hostname is already there if nothing was inserted
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO hosts (hostname, osladdr) VALUES (?, ?)",
+                (hostname, osladdr))
+            nrow = cur.rowcount
+            cur.close()
+            if nrow == 0:
+                r._hostcache_evict(hostname)
+                raise ErrHostDup
+
+        r._hostcache_put(hostname, osladdr)
 
     @_regerr
     def query(r, hostname):
+        osladdr = r._hostcache_get(hostname)
+        if osladdr is not None:
+            return osladdr
+
         with r._dbpool.xget() as conn:
             rowv = query(conn, "SELECT osladdr FROM hosts WHERE hostname = ?", hostname)
             if len(rowv) == 0:
                 return None
             if len(rowv) > 1:
                 raise Error("registry broken: duplicate host entries")
-            return rowv[0][0]
+            osladdr = rowv[0][0]
+
+        r._hostcache_put(hostname, osladdr)
+        return osladdr
+
+    # _hostcache_get returns cached osladdr for hostname, or None.
+    def _hostcache_get(r, hostname):
+        with r._hostcachemu:
+            osladdr = r._hostcache.pop(hostname, None)
+            if osladdr is not None:
+                r._hostcache[hostname] = osladdr    # mark as most recently used
+            return osladdr
+
+    # _hostcache_put caches hostname -> osladdr, evicting least recently used
+    # entry if cache is full.
+    def _hostcache_put(r, hostname, osladdr):
+        with r._hostcachemu:
+            r._hostcache.pop(hostname, None)
+            r._hostcache[hostname] = osladdr
+            if len(r._hostcache) > r.hostcache_max:
+                r._hostcache.popitem(last=False)
+
+    # _hostcache_evict removes hostname from the cache.
+    def _hostcache_evict(r, hostname):
+        with r._hostcachemu:
+            r._hostcache.pop(hostname, None)
 
 
 # query executes query on connection, fetches and returns all rows as [].
 def query(conn, sql, *argv):
-    rowi = conn.execute(sql, argv)
-    return list(rowi)
+    cur = conn.execute(sql, argv)
+    try:
+        return cur.fetchall()
+    finally:
+        cur.close()
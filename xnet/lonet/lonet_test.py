@@ -23,18 +23,34 @@ xerr  = gimport('lab.nexedi.com/kirr/go123/xerr')
 lonet = gimport('lab.nexedi.com/kirr/go123/xnet/lonet')
 
 from threading import Thread
-from cStringIO import StringIO
 import errno, logging as log
 
 
-def xread(sk):
-    # XXX might get only part of sent data
-    return sk.recv(4096)
+# xread reads exactly n bytes from sk.
+def xread(sk, n):
+    datav = []
+    while n > 0:
+        data = sk.recv(n)
+        if not data:
+            raise RuntimeError("xread: unexpected EOF")
+        datav.append(data)
+        n -= len(data)
+    return "".join(datav)
 
 def xwrite(sk, data):
     sk.sendall(data)
 
 
+# _LogRecorder is log handler that only remembers emitted records.
+class _LogRecorder(log.Handler):
+    def __init__(self):
+        log.Handler.__init__(self)
+        self.recordv = []
+
+    def emit(self, record):
+        self.recordv.append(record)
+
+
 # TODO test that fd of listener can be used in select/epoll
 # TODO non-blocking mode
 
@@ -44,25 +60,28 @@ def xwrite(sk, data):
 @func
 def _test_virtnet_basic(subnet):
     # (verifying that error log stays empty)
-    errorlog  = StringIO()
-    errorlogh = log.StreamHandler(errorlog)
+    errorlogh = _LogRecorder()
     l = log.getLogger()
     l.addHandler(errorlogh)
     def _():
         l.removeHandler(errorlogh)
-        assert errorlog.getvalue() == ""
+        assert errorlogh.recordv == []
     defer(_)
 
     defer(subnet.close)
 
+    network = subnet.network()
     def xaddr(addr):
-        return lonet.Addr.parse(subnet.network(), addr)
+        return lonet.Addr.parse(network, addr)
+
+    # error of dial from α:<src> to α:0
+    errrefused = "dial %s α:%%d->α:0: [Errno %d] connection refused" % (network, errno.ECONNREFUSED)
 
     ha = subnet.new_host("α")
     hb = subnet.new_host("β")
 
-    assert ha.network() == subnet.network()
-    assert hb.network() == subnet.network()
+    assert ha.network() == network
+    assert hb.network() == network
     assert ha.name() == "α"
     assert hb.name() == "β"
 
@@ -70,7 +89,7 @@ def _test_virtnet_basic(subnet):
         ha.dial(":0")
     except Exception as e:
         assert xerr.cause(e) is lonet.ErrConnRefused
-        assert str(e) == "dial %s α:1->α:0: [Errno %d] connection refused" % (subnet.network(), errno.ECONNREFUSED)
+        assert str(e) == errrefused % 1
     else:
         assert 0, "connection not refused"
 
@@ -81,7 +100,7 @@ def _test_virtnet_basic(subnet):
         ha.dial(":0")
     except Exception as e:
         assert xerr.cause(e) is lonet.ErrConnRefused
-        assert str(e) == "dial %s α:2->α:0: [Errno %d] connection refused" % (subnet.network(), errno.ECONNREFUSED)
+        assert str(e) == errrefused % 2
     else:
         assert 0, "connection not refused"
 
@@ -93,7 +112,7 @@ def _test_virtnet_basic(subnet):
         assert c1s.remote_addr() == xaddr("β:1")
         assert c1s.getpeername() == ("β", 1)
 
-        assert xread(c1s) == "ping"
+        assert xread(c1s, 4) == "ping"
         xwrite(c1s, "pong")
 
         c2s = l1.accept()
@@ -102,7 +121,7 @@ def _test_virtnet_basic(subnet):
         assert c2s.remote_addr() == xaddr("β:2")
         assert c2s.getpeername() == ("β", 2)
 
-        assert xread(c2s) == "hello"
+        assert xread(c2s, 5) == "hello"
         xwrite(c2s, "world")
 
 
@@ -116,7 +135,7 @@ def _test_virtnet_basic(subnet):
     assert c1c.getpeername() == ("α", 2)
 
     xwrite(c1c, "ping")
-    assert xread(c1c) == "pong"
+    assert xread(c1c, 4) == "pong"
 
     c2c = hb.dial("α:1")
     assert c2c.local_addr()  == xaddr("β:2")
@@ -125,7 +144,7 @@ def _test_virtnet_basic(subnet):
     assert c2c.getpeername() == ("α", 3)
 
     xwrite(c2c, "hello")
-    assert xread(c2c) == "world"
+    assert xread(c2c, 5) == "world"
 
     tsrv.join()
 
@@ -140,6 +159,46 @@ def test_lonet_py_basic():
     _test_virtnet_basic(subnet)
 
 
+# verify how host allocates and reuses ports.
+@func
+def test_lonet_py_portalloc():
+    subnet = lonet.join("")
+    defer(subnet.close)
+
+    def xaddr(addr):
+        return lonet.Addr.parse(subnet.network(), addr)
+
+    h = subnet.new_host("α")
+
+    l1 = h.listen(":0")
+    l2 = h.listen(":0")
+    l3 = h.listen(":0")
+    assert l1.addr() == xaddr("α:1")
+    assert l2.addr() == xaddr("α:2")
+    assert l3.addr() == xaddr("α:3")
+
+    # freed ports are reused lowest first
+    l2.close()
+    l1.close()
+    assert h.listen(":0").addr() == xaddr("α:1")
+    assert h.listen(":0").addr() == xaddr("α:2")
+    assert h.listen(":0").addr() == xaddr("α:4")
+
+    # listen on explicit high port; ports below it are allocated from the bottom
+    assert h.listen(":10").addr() == xaddr("α:10")
+    assert h.listen(":0").addr()  == xaddr("α:5")
+
+    # explicitly taken free port is skipped by further allocations
+    assert h.listen(":6").addr()  == xaddr("α:6")
+    assert h.listen(":0").addr()  == xaddr("α:7")
+
+    # listen/close on explicit port many times does not accumulate free ports
+    for i in range(100):
+        h.listen(":20").close()
+    assert len(h._freeports) <= len(h._socketv)
+    assert h.listen(":0").addr()  == xaddr("α:8")
+
+
 # test interaction with lonet.go
 @func
 def test_lonet_py_go(network):
@@ -155,7 +214,7 @@ def test_lonet_py_go(network):
     c1 = hb.dial("α:1")
     assert c1.local_addr() == xaddr("β:2")
     assert c1.remote_addr() == xaddr("α:2")
-    assert xread(c1) == "hello py"
+    assert xread(c1, 8) == "hello py"
     xwrite(c1, "hello go")
     c1.close()
 
@@ -163,7 +222,7 @@ def test_lonet_py_go(network):
     assert c2.local_addr() == xaddr("β:2")
     assert c2.remote_addr() == xaddr("α:2")
     xwrite(c2, "hello2 go")
-    assert xread(c2) == "hello2 py"
+    assert xread(c2, 9) == "hello2 py"
     c2.close()
 
 
@@ -194,3 +253,39 @@ def test_registry_pygo(registry_dbpath):
         assert 0, 'duplicate host announce not detected'
 
     # ok - hand over checks back to go side.
+
+
+# verify registry caching of found hosts.
+def test_registry_hostcache(tmpdir):
+    r = lonet.SQLiteRegistry(str(tmpdir.join("registry.db")), "ccc")
+    r.hostcache_max = 2
+
+    r.announce("α", "alpha:1")
+    r.announce("β", "beta:1")
+    r.announce("γ", "gamma:1")
+    # least recently used entry is evicted when cache is full
+    assert list(r._hostcache.items()) == [("β", "beta:1"), ("γ", "gamma:1")]
+
+    # query marks entry as most recently used
+    assert r.query("β") == "beta:1"
+    assert list(r._hostcache) == ["γ", "β"]
+
+    # entry that was evicted is still found via database
+    assert r.query("α") == "alpha:1"
+    assert list(r._hostcache) == ["β", "α"]
+
+    # absent hosts are not cached
+    assert r.query("δ") is None
+    assert list(r._hostcache) == ["β", "α"]
+
+    # duplicate announce evicts entry
+    try:
+        r.announce("α", "alpha:2")
+    except lonet.RegistryError as e:
+        assert ": host already registered" in str(e)
+    else:
+        assert 0, 'duplicate host announce not detected'
+    assert list(r._hostcache) == ["β"]
+    assert r.query("α") == "alpha:1"
+
+    r.close()
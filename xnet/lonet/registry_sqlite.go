@@ -135,7 +135,7 @@ func (r *sqliteRegistry) setup(ctx context.Context, network string) (err error)
 			CREATE TABLE IF NOT EXISTS hosts (
 				hostname	TEXT NON NULL PRIMARY KEY,
 				osladdr		TEXT NON NULL
-			);
+			) WITHOUT ROWID;
 
 			CREATE TABLE IF NOT EXISTS meta (
 				name		TEXT NON NULL PRIMARY KEY,